@@ -1,12 +1,18 @@
+import datetime
+import decimal
+import hashlib
+import itertools
 import json
 import os
 import random
 import re
 import requests
 import sys
+import time
 
 from boto3 import client as boto3_client
-lambda_client = boto3_client('lambda', region_name="us-west-2",)
+from boto3.dynamodb.types import TypeDeserializer
+deserializer = TypeDeserializer()
 
 sys.path.append('/opt')
 
@@ -20,11 +26,13 @@ import moses_common.timer
 import moses_common.ui
 import moses_common.visual_artists as visual_artists
 
+import image_index
+
 
 ui = moses_common.ui.Interface(use_slack_format=True, usage_message="""
 Select an image from the database.
   api.py
-  
+
   Options:
     -h, --help                  This help screen.
     -n, --dry_run               Run without updating anything.
@@ -35,41 +43,207 @@ Select an image from the database.
 log_level = 6
 dry_run = False
 
-secret = moses_common.secrets_manager.Secret('artintelligence.gallery/api_keys')
-api_keys = secret.get_value()
+images_table_name = 'artintelligence.gallery-images'
+batch_get_size = 100
+batch_get_retries = 5
+# Deletes never reach the update scan, so this container compares keys with the table this often
+reconcile_interval = 6 * 3600
+# Re-read this far behind the watermark, since the generator writes images after stamping create_time
+update_overlap = datetime.timedelta(minutes=10)
+# Scores set from the critique page, 1 (fail) through 5 (excellent)
+scores = range(1, 6)
+record_cache = image_index.LRUCache(max_size=2000, max_bytes=16 * 1024 * 1024)
+
+snapshot_path = '/tmp/image-index.snapshot'
+if common.is_local():
+	snapshot_path = os.environ['HOME'] + '/image-index.snapshot'
+
+# Dependencies are created on first use so routes only pay for what they touch
+api_keys = None
+collective = None
+images_table = None
+images = None
+images_checked = False
+images_reconcile_time = 0
+clients = {}
+init_timings = {}
+artist_count = None
+artist_count_time = 0
+artist_count_ttl = 3600
+
+# Cache-Control for the public read routes, whose content only changes with the catalogue
+cache_control = {
+	"get": "public, max-age=300",
+	"counts": "public, max-age=60",
+	"get_artists": "public, max-age=3600",
+	"get_genre_list": "public, max-age=3600"
+}
+
+
+def timed_init(name, function):
+	start = time.time()
+	value = function()
+	init_timings[name] = round(time.time() - start, 3)
+	ui.warning(f"Initialized {name} in {init_timings[name]}s")
+	return value
+
+def get_client(service):
+	if service not in clients:
+		clients[service] = timed_init(f"{service} client", lambda: boto3_client(service, region_name="us-west-2",))
+	return clients[service]
 
-collective = moses_common.collective.Collective(google_search_api_key=api_keys['GOOGLE_SEARCH_API_KEY'], google_search_project_cx=api_keys['GOOGLE_SEARCH_PROJECT_CX'], log_level=log_level, dry_run=dry_run)
+def get_api_keys():
+	global api_keys
+	if api_keys is None:
+		secret = moses_common.secrets_manager.Secret('artintelligence.gallery/api_keys')
+		api_keys = timed_init('api_keys', secret.get_value)
+	return api_keys
+
+def get_collective():
+	global collective
+	if collective is None:
+		keys = get_api_keys()
+		collective = timed_init('collective', lambda: moses_common.collective.Collective(google_search_api_key=keys['GOOGLE_SEARCH_API_KEY'], google_search_project_cx=keys['GOOGLE_SEARCH_PROJECT_CX'], log_level=log_level, dry_run=dry_run))
+	return collective
+
+def get_artist_count():
+	# DynamoDB only refreshes the item count every few hours
+	global artist_count
+	global artist_count_time
+	if artist_count is None or time.time() - artist_count_time > artist_count_ttl:
+		artists_table = moses_common.dynamodb.Table('artintelligence.gallery-artists')
+		artist_count = artists_table.item_count
+		artist_count_time = time.time()
+	return artist_count
+
+def get_images_table():
+	global images_table
+	if images_table is None:
+		images_table = timed_init('images_table', lambda: moses_common.dynamodb.Table(images_table_name, log_level=log_level, dry_run=dry_run))
+	return images_table
+
+def get_images():
+	# Load on first use and check for updates once per request
+	global images
+	global images_checked
+	global images_reconcile_time
+	if images is None:
+		images = timed_init('images', lambda: load_image_index(get_images_table()))
+		images_reconcile_time = time.time()
+	elif not images_checked:
+		if get_collective().images_were_updated():
+			images = read_image_updates(get_images_table(), images)
+		if time.time() - images_reconcile_time > reconcile_interval:
+			images_reconcile_time = time.time()
+			remove_deleted_images(images)
+	images_checked = True
+	return images
 
 
 def read_image_records(table):
 	timer = moses_common.timer.Timer('Loaded index')
-	records = table.get_keys(['nsfw', 'score', 'aspect_ratio', 'query-artist_name', 'query-subject', 'query-style'])
+	records = table.get_keys(image_index.INDEX_FIELDS)
 	ui.warning(timer.stop())
+	index = image_index.ImageIndex(records, log_level=log_level)
+	index.write_snapshot(snapshot_path)
+	record_cache.clear()
+	
+	get_collective().images_were_read()
+	return index
+
+def read_image_updates(table, index):
+	if not index.watermark:
+		return read_image_records(table)
+	timer = moses_common.timer.Timer('Loaded index updates')
+	fields = ['filename', 'create_time'] + image_index.INDEX_FIELDS
+	names = { '#' + re.sub(r'\W', '_', field): field for field in fields }
+	records = []
+	try:
+		paginator = get_client('dynamodb').get_paginator('scan')
+		pages = paginator.paginate(
+			TableName = images_table_name,
+			ProjectionExpression = ', '.join(names.keys()),
+			FilterExpression = '#create_time >= :watermark OR #update_time >= :watermark',
+			ExpressionAttributeNames = names,
+			ExpressionAttributeValues = { ":watermark": { "S": get_update_start(index.watermark) } }
+		)
+		for page in pages:
+			for item in page['Items']:
+				records.append(deserialize_item(item))
+	except Exception as e:
+		ui.error(f"Failed to read image updates: {e}")
+		return read_image_records(table)
+	ui.warning(timer.stop())
+	updated = index.merge(records)
 	for record in records:
-		record['id'] = common.get_epoch(record['create_time'] + '+00:00')
-		if 'query-artist_id' not in record and 'query-artist_name' in record:
-			record['query-artist_id'] = common.convert_to_snakecase(common.normalize(record['query-artist_name'], strip_single_chars=False))
-		# SD 1.5 Checkpoints
-		if record['id'] <= 1690216293:
-			record['version'] = 1
-		# SDXL Beta + GPT
-		elif record['id'] <= 1691577582:
-			record['version'] = 2
-		# SDXL 1.0 + GPT
-		elif record['id'] <= 1693321367:
-			record['version'] = 3
-		# SDXL 1.0
-		elif record['id'] <= 1718234171:
-			record['version'] = 4
-		# SD3
-		else:
-			record['version'] = 5
+		record_cache.discard(record['filename'])
+	if updated:
+		index.write_snapshot(snapshot_path)
 	
-	collective.images_were_read()
-	return records
+	get_collective().images_were_read()
+	return index
+
+def remove_deleted_images(index):
+	# Only the keys are read, and the index drops the missing images in place
+	timer = moses_common.timer.Timer('Loaded image keys')
+	filenames = set()
+	try:
+		paginator = get_client('dynamodb').get_paginator('scan')
+		pages = paginator.paginate(
+			TableName = images_table_name,
+			ProjectionExpression = '#filename',
+			ExpressionAttributeNames = { "#filename": "filename" }
+		)
+		for page in pages:
+			for item in page['Items']:
+				filenames.add(item['filename']['S'])
+	except Exception as e:
+		ui.error(f"Failed to read image keys: {e}")
+		return 0
+	ui.warning(timer.stop())
+	return remove_images(index, [filename for filename in index.filename if filename not in filenames])
+
+def remove_images(index, filenames):
+	removed = index.remove(filenames)
+	for filename in filenames:
+		record_cache.discard(filename)
+	if removed:
+		ui.warning(f"Removed {removed} deleted images from the index")
+		index.write_snapshot(snapshot_path)
+	return removed
+
+def get_update_start(watermark):
+	# Timestamps don't follow write order: set_score can stamp update_time while
+	# an older create_time is still being generated, so overlap the last read
+	try:
+		start = datetime.datetime.fromisoformat(watermark[:19]) - update_overlap
+	except ValueError:
+		return ''
+	return start.isoformat(sep=watermark[10:11] or 'T')
+
+def download_snapshot():
+	# Published by 'manage.py publish_index'
+	s3_client = get_client('s3')
+	try:
+		response = s3_client.get_object(Bucket=image_index.SNAPSHOT_BUCKET, Key=image_index.SNAPSHOT_POINTER)
+		pointer = json.loads(response['Body'].read())
+		s3_client.download_file(image_index.SNAPSHOT_BUCKET, pointer['key'], snapshot_path)
+	except Exception as e:
+		ui.warning(f"No published index snapshot: {e}")
+		return False
+	return True
+
+def load_image_index(table):
+	# Start from this container's snapshot, then the published one
+	timer = moses_common.timer.Timer('Loaded index snapshot')
+	index = image_index.ImageIndex.read_snapshot(snapshot_path, log_level=log_level)
+	if not index and download_snapshot():
+		index = image_index.ImageIndex.read_snapshot(snapshot_path, log_level=log_level)
+	if not index:
+		return read_image_records(table)
+	ui.warning(timer.stop())
+	return read_image_updates(table, index)
 
-images_table = moses_common.dynamodb.Table('artintelligence.gallery-images', log_level=log_level, dry_run=dry_run)
-image_records = read_image_records(images_table)
 image_timer = moses_common.timer.Refresh()
 
 artist_list_location = '/tmp'
@@ -80,10 +254,9 @@ if common.is_local():
 def handler(event, context):
 	global log_level
 	global dry_run
-	global image_records
+	global images_checked
 	
-	if collective.images_were_updated():
-		image_records = read_image_records(images_table)
+	images_checked = False
 	
 	api = moses_common.api_gateway.Request(event, log_level=7, dry_run=dry_run)
 	
@@ -97,6 +270,7 @@ def handler(event, context):
 	output = {}
 	if path:
 		action = path.pop(0)
+		cache_route = get_cache_route(action, path, body)
 		if action == 'get':
 			if path:
 				image_id = path.pop(0)
@@ -156,22 +330,22 @@ def handler(event, context):
 				output = { "status": 405, "error": "Method not allowed" }
 		elif action == 'counts':
 			if method == 'GET':
-				artists_table = moses_common.dynamodb.Table('artintelligence.gallery-artists')
-				images = 0
-				fails = 0
-				for record in image_records:
-					if 'nsfw' in record and record['nsfw']:
-						continue
-					if 'score' in record and record['score'] == 1:
-						fails += 1
-						continue
-					if 'score' in record and record['score'] < 3:
-						continue
-					images += 1
+				output = get_images().get_counts()
+				output['artists'] = get_artist_count()
+			else:
+				output = { "status": 405, "error": "Method not allowed" }
+		elif action == 'facets':
+			if method == 'POST':
+				output = get_facets(body)
+			else:
+				output = { "status": 405, "error": "Method not allowed" }
+		elif action == 'index_stats':
+			if method == 'GET':
 				output = {
-					"images": images,
-					"artists": artists_table.item_count,
-					"fails": fails
+					"status": "success",
+					"index": get_images().get_stats(),
+					"records": record_cache.get_stats(),
+					"init_timings": init_timings
 				}
 			else:
 				output = { "status": 405, "error": "Method not allowed" }
@@ -200,17 +374,57 @@ def handler(event, context):
 		"statusCode": 200,
 		"body": common.make_json(output)
 	}
+	if cache_route and output.get('status', 'success') == 'success':
+		etag = get_etag(response['body'])
+		if etag_matches(event, etag):
+			return get_not_modified_response(etag, cache_route)
+		response['headers'] = {
+			"ETag": etag,
+			"Cache-Control": cache_control[cache_route]
+		}
 	if log_level >= 6:
 # 		del output['image']['artist']
 		ui.body(f"output: {output}")
-	
+
 # 	print("response {}: {}".format(type(response), response))
 	return response
 
 
+def get_cache_route(action, path, body):
+	# Only specific images are cacheable under get, not latest, random or shuffle
+	if action == 'get':
+		if path and re.match(r'^\d{10}$', path[0]) and (body or {}).get('mode') != 'shuffle':
+			return action
+		return None
+	if action in cache_control:
+		return action
+	return None
+
+def get_etag(body):
+	return '"' + hashlib.sha1(body.encode('utf-8')).hexdigest() + '"'
+
+def etag_matches(event, etag):
+	headers = event.get('headers') or {}
+	if_none_match = next((value for name, value in headers.items() if name.lower() == 'if-none-match'), None)
+	if not if_none_match:
+		return False
+	tags = [re.sub(r'^W/', '', tag.strip()) for tag in if_none_match.split(',')]
+	return etag in tags or '*' in tags
+
+def get_not_modified_response(etag, cache_route):
+	return {
+		"statusCode": 304,
+		"headers": {
+			"ETag": etag,
+			"Cache-Control": cache_control[cache_route]
+		}
+	}
+
+
 def get_artists():
+	# Image counts per artist are in /facets, so this route never loads the index
 	artist_list = []
-	for artist in collective.artists:
+	for artist in get_collective().artists:
 		name_parts = re.split(r', ', artist.sort_name);
 		name_parts.append(name_parts.pop(0))
 		artist_name = common.normalize(' '.join(name_parts), False)
@@ -228,9 +442,9 @@ def get_artists():
 def get_artist(body):
 	artist = None
 	if 'artist_id' in body:
-		artist = collective.get_artist_by_id(body['artist_id'])
+		artist = get_collective().get_artist_by_id(body['artist_id'])
 	elif 'artist' in body:
-		artist = collective.get_artist_by_name(body['artist'])
+		artist = get_collective().get_artist_by_name(body['artist'])
 	else:
 		return error("Missing 'artist_id' argument")
 	
@@ -244,7 +458,7 @@ def get_artist(body):
 	return artist_info
 
 def get_genre_list():
-	genre_list = collective.get_genre_list()
+	genre_list = get_collective().get_genre_list()
 	return {
 		"status": "success",
 		"artists": genre_list,
@@ -254,7 +468,7 @@ def get_genre_list():
 def get_genres(body):
 	if 'artist_id' not in body:
 		return error("Missing 'artist_id' argument")
-	artist = collective.get_artist_by_id(body['artist_id'])
+	artist = get_collective().get_artist_by_id(body['artist_id'])
 	if not artist:
 		return error(f"Artist '{artist_id}' not found")
 	return {
@@ -269,7 +483,7 @@ def save_genre(body):
 	if 'name' not in body:
 		return error("Missing 'name' argument")
 	
-	artist = collective.get_artist_by_id(body['artist_id'])
+	artist = get_collective().get_artist_by_id(body['artist_id'])
 	if not artist:
 		return error(f"Artist '{artist_id}' not found")
 	
@@ -288,7 +502,7 @@ def delete_genre(body):
 	if 'name' not in body:
 		return error("Missing 'name' argument")
 	
-	artist = collective.get_artist_by_id(body['artist_id'])
+	artist = get_collective().get_artist_by_id(body['artist_id'])
 	if not artist:
 		return error(f"Artist '{artist_id}' not found")
 	
@@ -304,9 +518,9 @@ def delete_genre(body):
 def get_search_results(body):
 	artist = None
 	if 'artist_id' in body:
-		artist = collective.get_artist_by_id(body['artist_id'])
+		artist = get_collective().get_artist_by_id(body['artist_id'])
 	elif 'artist' in body:
-		artist = collective.get_artist_by_name(body['artist'])
+		artist = get_collective().get_artist_by_name(body['artist'])
 	else:
 		return error("Missing 'artist_id' argument")
 	
@@ -326,25 +540,53 @@ def get_search_results(body):
 		}),
 		"total": len(results)
 	}
+
+
+def curate(body, start=None, reverse=True):
+	# Matches are yielded lazily, so callers only pay for what they read
+	positions = search_positions(body)
+	if positions is not None:
+		for pos in (reversed(positions) if reverse else positions):
+			if start is None or (pos <= start if reverse else pos >= start):
+				yield pos
+		return
 	
+	yield from get_images().iter_matches(get_filters(body), start, reverse)
 
-def curate(body, image_id=None):
-	final_records = []
+def get_total(body):
+	positions = search_positions(body)
+	if positions is not None:
+		return len(positions)
+	return get_images().count(get_filters(body))
+
+def search_positions(body):
+	# An id or filename search ignores the other filters
+	images = get_images()
 	if 'search' in body and body['search']:
 		search = body['search'].strip()
 		if common.is_int(search) and len(search) == 10:
 			print("id search")
-			for record in image_records:
-				if record['id'] == common.convert_to_int(search):
-					final_records.append(record)
-			return final_records
+			pos = images.find_id(common.convert_to_int(search))
+			if pos is None:
+				return []
+			return [pos]
 		elif re.match(r'\S+\.png$', search):
 			print("filename search")
-			for record in image_records:
-				if record['filename'] == search:
-					return [record]
-			return []
-	
+			pos = images.find_filename(search)
+			if pos is None:
+				return []
+			return [pos]
+	return None
+
+def sample(body, count):
+	positions = search_positions(body)
+	if positions is None:
+		return get_images().sample(get_filters(body), count)
+	if not positions:
+		return [], 0
+	return [random.choice(positions) for i in range(count)], len(positions)
+
+def get_filters(body):
 	min_aspect_ratio = 0.1
 	max_aspect_ratio = 10.0
 	if 'min_aspect_ratio' in body:
@@ -361,194 +603,201 @@ def curate(body, image_id=None):
 		min_aspect_ratio = 1.0
 		max_aspect_ratio = 1.0
 	
-	has_nsfw = False
+	nsfw = None
 	if 'nsfw' in body:
-		has_nsfw = True
-	get_nsfw = common.convert_to_bool(body.get('nsfw')) or False
+		nsfw = common.convert_to_bool(body.get('nsfw')) or False
 	
 	exact_score = common.convert_to_int(body.get('exact_score')) or None
 	if body.get('exact_score') == 'no_score':
 		exact_score = 'no_score'
-	score = common.convert_to_int(body.get('score')) or None
 	
-	exact_version = common.convert_to_int(body.get('exact_version')) or None
-	version = common.convert_to_int(body.get('version')) or None
+	return {
+		"search": common.normalize(body['search']) if body.get('search') else None,
+		"artist": common.normalize(body['artist']) if body.get('artist') else None,
+		"artist_id": body.get('artist_id') or None,
+		"min_aspect_ratio": min_aspect_ratio,
+		"max_aspect_ratio": max_aspect_ratio,
+		"nsfw": nsfw,
+		"exact_score": exact_score,
+		"score": common.convert_to_int(body.get('score')) or None,
+		"exact_version": common.convert_to_int(body.get('exact_version')) or None,
+		"version": common.convert_to_int(body.get('version')) or None
+	}
+
+
+def get_image(image_id, body):
+	if 'mode' in body and body['mode'] == 'shuffle':
+		return get_shuffled_image(image_id, body)
+	
+	images = get_images()
+	if image_id == 'latest':
+		image_pos = next(curate(body), None)
+		if image_pos is None:
+			return {
+				"status": "success",
+				"total": 0
+			}
+	else:
+		image_pos = images.find_id(common.convert_to_int(image_id))
+		if image_pos is None or next(curate(body, image_pos), None) != image_pos:
+			if image_pos is not None and log_level >= 6:
+				ui.body(f"log: {image_id} filtered out by {get_filters(body)}")
+			return {
+				"status": "fail",
+				"total": 0
+			}
 	
-	# Load all keys
-	for record in image_records:
-		include = True
-		log = []
-		
-		if body.get('search') or body.get('artist') or body.get('artist_id'):
-			include = False
-		
-		if body.get('search'):
-			log.append('search')
-			re_match = re.compile(r'\b{}\b'.format(common.normalize(body['search'])), re.IGNORECASE)
-			if re.search(re_match, common.normalize(record.get('query-artist_name', ''))):
-				log.append('  Match on query-artist_name')
-				include = True
-			elif re.search(re_match, common.normalize(record.get('query-subject', ''))):
-				log.append('  Match on query-subject')
-				include = True
-			elif re.search(re_match, common.normalize(record.get('query-style', ''))):
-				log.append('  Match on query-style')
-				include = True
-		
-		if body.get('artist_id'):
-			log.append('artist_id')
-			if body['artist_id'] == record.get('query-artist_id', ''):
-				log.append('  Match on query-artist_id')
-				include = True
-		
-		if body.get('artist'):
-			log.append('artist')
-			re_match = re.compile(r'\b{}\b'.format(common.normalize(body['artist'])), re.IGNORECASE)
-			if re.search(re_match, common.normalize(record.get('query-artist_name', ''))):
-				log.append('  Match on query-artist_name')
-				include = True
-		
-		
-		if record['aspect_ratio'] > max_aspect_ratio or record['aspect_ratio'] < min_aspect_ratio:
-			log.append('Filter out on aspect ratio')
-			include = False
-		
-		if has_nsfw:
-			if not get_nsfw and record.get('nsfw'):
-				log.append('Filter out on nsfw 1')
-				include = False
-			if get_nsfw and not record.get('nsfw'):
-				log.append('Filter out on nsfw 2')
-				include = False
-		
-		if exact_score == 'no_score':
-			if 'score' in record:
-				log.append('Filter out on no score')
-				include = False
-		elif exact_score:
-			if exact_score != record.get('score', 0):
-				log.append('Filter out on exact score')
-				include = False
-		elif score and (not record.get('score') or score > record['score']):
-			log.append('Filter out on score')
-			include = False
-		
-		if exact_version:
-			if exact_version != record['version']:
-				log.append('Filter out on exact version')
-				include = False
-		elif version and version > record['version']:
-			log.append('Filter out on version')
-			include = False
-		
-		if image_id != 'latest' and common.convert_to_int(image_id) == record['id'] and log_level >= 6:
-			ui.body(f"log: {log}")
-		
-		if include:
-			final_records.append(record)
-		
-	return final_records
+	# Positions are in create_time order, so neighbours are the next matches either side
+	older_pos = next(curate(body, image_pos - 1), None)
+	newer_pos = next(curate(body, image_pos + 1, reverse=False), None)
+	
+	response = get_image_response(image_pos, get_total(body))
+	if response['status'] != 'success':
+		return response
+	
+	# Add next and prev records, wrapping around at either end
+	if newer_pos is None:
+		newer_pos = next(curate(body, reverse=False))
+	response['newer_id'] = images.id[newer_pos]
 	
+	if older_pos is None:
+		older_pos = next(curate(body))
+	response['older_id'] = images.id[older_pos]
+	
+	return response
 
-def get_image(image_id, body):
-	final_records = curate(body, image_id)
-	if not final_records:
+def get_shuffled_image(image_id, body):
+	images = get_images()
+	positions = search_positions(body)
+	session = None
+	if positions is None:
+		filters = get_filters(body)
+		session, size, position = get_shuffle_session(body, filters)
+		picks = images.get_shuffled(filters, session['seed'], size, position, 2)
+		total = images.count(filters) if picks else 0
+	else:
+		picks, total = sample(body, 2)
+	if not total:
 		return {
 			"status": "success",
 			"total": 0
 		}
 	
-	final_records = sorted(final_records, key=lambda d: d['create_time'])
-	
 	if image_id == 'latest':
-		if 'mode' in body and body['mode'] == 'shuffle':
-			index = random.randrange(len(final_records))
-			image_id = final_records[index]['id']
-		else:
-			image_id = final_records[-1]['id']
-	image_id = common.convert_to_int(image_id)
-	
-	older_id = None
-	newer_id = None
-	image_record = None
-	for record in final_records:
-		if image_record:
-			newer_id = record['id']
-			break
-		elif image_id == record['id']:
-			image_record = record
+		image_pos = picks[0]
+	else:
+		image_pos = images.find_id(common.convert_to_int(image_id))
+		if positions is not None:
+			matches = image_pos in positions
 		else:
-			older_id = record['id']
+			matches = image_pos is not None and images.matches(image_pos, filters)
+		if not matches:
+			return {
+				"status": "fail",
+				"total": 0
+			}
 	
+	response = get_image_response(image_pos, total)
+	if response['status'] != 'success':
+		return response
+	response['random_id'] = images.id[picks[-1]]
+	if session:
+		response['session'] = session['token']
+		response['position'] = position + 1
+	return response
+
+def get_shuffle_session(body, filters):
+	# Tokens are hex seed.size.filter_hash; other filters start a new session
+	filter_hash = image_index.get_filter_hash(filters)
+	match = re.match(r'^([0-9a-f]{1,16})\.([0-9a-f]{1,16})\.([0-9a-f]{8})$', str(body.get('session') or ''))
+	if match and match.group(3) == filter_hash and int(match.group(2), 16):
+		seed = int(match.group(1), 16)
+		# Never shuffle more than there are matches, which would repeat images once some are deleted
+		size = min(int(match.group(2), 16), get_images().count(filters))
+		position = max(0, common.convert_to_int(body.get('position')))
+	else:
+		seed = random.getrandbits(32)
+		size = get_images().count(filters)
+		position = 0
+	session = {
+		"seed": seed,
+		"token": f"{seed:x}.{size:x}.{filter_hash}"
+	}
+	return session, size, position
+
+def get_image_response(image_pos, total):
+	images = get_images()
+	image_record = get_image_record(images.filename[image_pos], images.create_time[image_pos])
 	if not image_record:
+		# Deleted since the index was read, and now dropped from it
 		return {
 			"status": "fail",
 			"total": 0
 		}
 	
-	image_record = get_image_record(image_record['filename'], image_record['create_time'])
-	
 	response = {
 		"status": "success",
 		"image": image_record,
-		"total": len(final_records)
+		"total": total
 	}
 	
 	if 'query-artist_id' in image_record:
-		artist = collective.get_artist_by_id(image_record['query-artist_id'])
+		artist = get_collective().get_artist_by_id(image_record['query-artist_id'])
 		if artist:
 			response['image']['artist'] = artist.data
-	
-	# Add next and prev records
-	if 'mode' in body and body['mode'] == 'shuffle':
-		index = random.randrange(len(final_records))
-		response['random_id'] = final_records[index]['id']
-	else:
-		if not newer_id:
-			newer_id = final_records[0]['id']
-		response['newer_id'] = newer_id
-		
-		if not older_id:
-			older_id = final_records[-1]['id']
-		response['older_id'] = older_id
-	
 	return response
 
 
+def get_facets(body):
+	facets = get_images().get_facets(get_filters(body))
+	return {
+		"status": "success",
+		"facets": facets,
+		"total": facets.pop('total')
+	}
+
+
 def get_random(body):
-	final_records = curate(body)
-	if not final_records:
+	limit = 1
+	if 'limit' in body and common.is_int(body['limit']):
+		limit = common.convert_to_int(body['limit'])
+	
+	# Continue a shuffle session, or pick keys at random
+	session = None
+	if 'session' in body and search_positions(body) is None:
+		images = get_images()
+		filters = get_filters(body)
+		session, size, position = get_shuffle_session(body, filters)
+		positions = images.get_shuffled(filters, session['seed'], size, position, limit)
+		total = images.count(filters) if positions else 0
+	else:
+		positions, total = sample(body, limit)
+	if not total:
 		return {
 			"status": "success",
 			"images": [],
 			"total": 0
 		}
-	
-	records = []
-	limit = 1
-	if 'limit' in body and common.is_int(body['limit']):
-		limit = common.convert_to_int(body['limit'])
-	
-	records = []
-	for i in range(limit):
-		# Pick key at random
-		index = random.randrange(len(final_records))
-		record = get_image_record(final_records[index]['filename'], final_records[index]['create_time'])
-		
+	records = get_image_records(positions)
+
+# 	for record in records:
 # 		record['url'] = get_presigned_url(record['filename'])
-		
-		records.append(record)
-	
-	return {
+
+	response = {
 		"status": "success",
 		"images": records,
-		"total": len(final_records)
+		"total": total
 	}
+	if session:
+		response['session'] = session['token']
+		response['position'] = position + len(positions)
+	return response
 
 
 def get_latest(body):
-	final_records = curate(body)
-	if not final_records:
+	# A cursor names the last image shown, so its pages don't shift as images arrive
+	total = get_total(body)
+	if not total:
 		return {
 			"status": "success",
 			"images": [],
@@ -556,38 +805,147 @@ def get_latest(body):
 			"total": 0
 		}
 	
-	final_records = sorted(final_records, key=lambda d: d['create_time'])
-	
-	# Get last record
-	offset = common.convert_to_int(body.get('offset'))
-	if offset > len(final_records):
-		offset = 1
-	if offset <= 0:
-		offset = len(final_records)
+	limit = max(1, common.convert_to_int(body.get('limit')) or 1)
+	if body.get('cursor'):
+		start = get_cursor_position(body['cursor'])
+		if start is None:
+			return {
+				"status": "fail",
+				"images": [],
+				"total": 0
+			}
+		positions = list(itertools.islice(curate(body, start - 1), limit + 1))
+		offset = get_newer_count(body, positions[0]) + 1 if positions else total + 1
+	else:
+		# Get last record
+		offset = common.convert_to_int(body.get('offset'))
+		if offset > total:
+			offset = 1
+		if offset <= 0:
+			offset = total
+		
+		if total - offset < limit:
+			limit = total - offset + 1
+		positions = list(itertools.islice(curate(body), offset - 1, offset + limit))
 	
-	limit = common.convert_to_int(body.get('limit')) or 1
-	if len(final_records) - offset < limit:
-		limit = len(final_records) - offset + 1
+	# One match past the page tells whether there is a next page
+	next_cursor = None
+	if len(positions) > limit:
+		positions = positions[:limit]
+		next_cursor = get_cursor(positions[-1])
 	
-	records = []
-	for i in range(offset, offset+limit):
-		index = -1 * i
-		record = get_image_record(final_records[index]['filename'], final_records[index]['create_time'])
+	records = get_image_records(positions)
+	for record in records:
 		record['offset'] = offset
-		
+
 # 		record['url'] = get_presigned_url(record['filename'])
-		records.append(record)
-	
+
 	return {
 		"status": "success",
 		"images": records,
 		"offset": offset,
-		"total": len(final_records)
+		"next_cursor": next_cursor,
+		"total": total
 	}
 
+def get_cursor(image_pos):
+	images = get_images()
+	return f"{images.create_time[image_pos]}|{images.filename[image_pos]}"
+
+def get_cursor_position(cursor):
+	create_time, separator, filename = str(cursor).partition('|')
+	if not separator or not create_time or not filename:
+		return None
+	return get_images().seek(create_time, filename)
+
+def get_newer_count(body, image_pos):
+	positions = search_positions(body)
+	if positions is not None:
+		return len([pos for pos in positions if pos > image_pos])
+	return get_images().count_newer(get_filters(body), image_pos)
+
 
 def get_image_record(filename, create_time):
-	record = images_table.get_item(filename, create_time)
+	record = record_cache.get(filename)
+	if not record:
+		record = get_images_table().get_item(filename, create_time)
+		if not record:
+			if images is not None:
+				remove_images(images, [filename])
+			return None
+		record = fix_image_record(record)
+		cache_image_record(record)
+	return record.copy()
+
+def cache_image_record(record):
+	record_cache.set(record['filename'], record, len(common.make_json(record)))
+
+def get_image_records(positions):
+	# Records come back in the order of positions, which may repeat
+	images = get_images()
+	items = {}
+	keys = {}
+	for pos in positions:
+		filename = images.filename[pos]
+		if filename not in items and filename not in keys:
+			record = record_cache.get(filename)
+			if record:
+				items[filename] = record
+			else:
+				keys[filename] = images.create_time[pos]
+	keys = list(keys.items())
+	complete = True
+	
+	for i in range(0, len(keys), batch_get_size):
+		request = {
+			images_table_name: {
+				"Keys": [ { "filename": { "S": filename }, "create_time": { "S": create_time } } for filename, create_time in keys[i:i+batch_get_size] ]
+			}
+		}
+		attempt = 0
+		while request:
+			response = get_client('dynamodb').batch_get_item(RequestItems=request)
+			for item in response['Responses'].get(images_table_name, []):
+				record = fix_image_record(deserialize_item(item))
+				cache_image_record(record)
+				items[record['filename']] = record
+			
+			request = response.get('UnprocessedKeys')
+			if request:
+				attempt += 1
+				if attempt > batch_get_retries:
+					ui.error(f"Gave up on {len(request[images_table_name]['Keys'])} unprocessed keys")
+					complete = False
+					break
+				time.sleep(0.05 * 2 ** attempt)
+	
+	records = []
+	for pos in positions:
+		if images.filename[pos] in items:
+			records.append(items[images.filename[pos]].copy())
+	# Keys the table no longer has were deleted since the index was read
+	if complete:
+		remove_images(images, [filename for filename, create_time in keys if filename not in items])
+	return records
+
+def deserialize_item(item):
+	record = {}
+	for key, value in item.items():
+		record[key] = convert_decimals(deserializer.deserialize(value))
+	return record
+
+def convert_decimals(value):
+	if isinstance(value, decimal.Decimal):
+		if value == value.to_integral_value():
+			return int(value)
+		return float(value)
+	elif isinstance(value, list):
+		return [convert_decimals(item) for item in value]
+	elif isinstance(value, dict):
+		return { key: convert_decimals(item) for key, item in value.items() }
+	return value
+
+def fix_image_record(record):
 	record['id'] = common.get_epoch(record['create_time'])
 	if record['engine_name'] == 'sdxl':
 		record['engine_label'] = 'Stable Diffusion XL Beta'
@@ -605,14 +963,14 @@ def get_presigned_url(filename):
 
 def generate(body):
 	if 'artist_id' in body:
-		artist = collective.get_artist_by_id(body['artist_id'])
+		artist = get_collective().get_artist_by_id(body['artist_id'])
 		body['artist'] = artist.name
 	data = {
 		"artist": body.get('artist'),
 		"genre": body.get('genre')
 	}
 	
-	function_response = lambda_client.invoke(
+	function_response = get_client('lambda').invoke(
 		FunctionName = 'art-intelligence-dev-generator',
 		InvocationType = 'Event',
 		Payload = common.make_json(data)
@@ -623,41 +981,43 @@ def generate(body):
 	}
 
 def set_score(body):
-	global image_records
 	for field in ['filename', 'create_time']:
 		if field not in body or not body[field]:
 			return error("Missing 'filename' and 'create_time' arguments.")
-	record = None
-	for image in image_records:
-		if image['filename'] == body['filename']:
-			record = image
-			break
-	if not record:
-		return error(f"No records matching '{image['filename']}'")
-		
+	images = get_images()
+	pos = images.find_filename(body['filename'])
+	if pos is None:
+		return error(f"No records matching '{body['filename']}'")
+	
 	
 	data = {
 		"filename": body['filename'],
 		"create_time": body['create_time'],
+		"update_time": common.convert_datetime_to_string(common.get_dt_now()),
 		"nsfw": False
 	}
 	
-	record['nsfw'] = False
 	if 'nsfw' in body and body['nsfw']:
 		data['nsfw'] = True
-		record['nsfw'] = True
 	if common.is_int(body.get('score')):
 		data['score'] = common.convert_to_int(body['score']);
-		record['score'] = data['score']
+		if data['score'] not in scores:
+			return error(f"Score must be from {scores[0]} to {scores[-1]}")
 	
-	success = images_table.update_item(data)
+	success = get_images_table().update_item(data)
 	
 	if not success:
 		return error("Failed to save changes to database")
-	image_records = read_image_records(images_table)
+	
+	# Write through to the index instead of reloading it
+	images.set_score(pos, score=data.get('score'), nsfw=data['nsfw'])
+	cached_record = record_cache.get(body['filename'])
+	if cached_record:
+		cached_record.update(data)
+		cache_image_record(cached_record)
 	return {
 		"status": "success",
-		"image": record
+		"image": images.get_record(pos)
 	}
 
 
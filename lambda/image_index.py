@@ -0,0 +1,997 @@
+import array
+import bisect
+import collections
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import random
+import re
+import struct
+
+import moses_common.__init__ as common
+
+
+SCORE_NONE = -1
+ARTIST_NONE = -1
+TEXT_FIELDS = ['query-artist_name', 'query-subject', 'query-style']
+# Fields read with each image key to build the index
+INDEX_FIELDS = ['nsfw', 'score', 'aspect_ratio', 'update_time'] + TEXT_FIELDS
+
+# Aspect ratio ranges of the orientation presets in api.get_filters()
+ORIENTATIONS = {
+	"portrait": (0.1, 0.9),
+	"square": (1.0, 1.0),
+	"landscape": (1.1, 10.0)
+}
+# Aspect ratios inside the default range but outside every preset
+ORIENTATION_OTHER = 'other'
+# Aspect ratios outside the default range
+ORIENTATION_NONE = None
+DEFAULT_ASPECT_RATIOS = (0.1, 10.0)
+# Sample by testing random positions while at least 1 in this many images match
+SAMPLE_DENSITY = 32
+
+# Model versions in order, with the id of the last image made with each.
+# A new engine gets a row here; the current one has no last id.
+VERSIONS = [
+	(1, 1690216293),	# SD 1.5 Checkpoints
+	(2, 1691577582),	# SDXL Beta + GPT
+	(3, 1693321367),	# SDXL 1.0 + GPT
+	(4, 1718234171),	# SDXL 1.0
+	(5, None)	# SD3
+]
+VERSION_NUMBERS = [version for version, last_id in VERSIONS]
+VERSION_LAST_IDS = [last_id for version, last_id in VERSIONS if last_id is not None]
+
+SNAPSHOT_BUCKET = 'artintelligence.gallery'
+SNAPSHOT_POINTER = 'index/images.json'
+SNAPSHOT_MAGIC = b'AIIX'
+SNAPSHOT_FORMAT = 3
+SNAPSHOT_ARRAYS = ['id', 'aspect_ratio', 'score', 'nsfw', 'artist']
+SNAPSHOT_STRINGS = ['filename', 'create_time', 'artist_ids']
+SNAPSHOT_STRING_COLUMNS = ['artist_name', 'subject', 'style', 'artist_text']
+
+
+def get_version(image_id):
+	return VERSIONS[bisect.bisect_left(VERSION_LAST_IDS, image_id)][0]
+
+
+def get_sort_key(record):
+	return (record['create_time'], record['filename'])
+
+
+def get_orientation(aspect_ratio):
+	for orientation, (min_aspect_ratio, max_aspect_ratio) in ORIENTATIONS.items():
+		if min_aspect_ratio <= aspect_ratio <= max_aspect_ratio:
+			return orientation
+	if DEFAULT_ASPECT_RATIOS[0] <= aspect_ratio <= DEFAULT_ASPECT_RATIOS[1]:
+		return ORIENTATION_OTHER
+	return ORIENTATION_NONE
+
+def get_orientations(filters):
+	# Orientation buckets that exactly cover the filter's aspect ratio range, or None
+	aspect_ratios = (filters['min_aspect_ratio'], filters['max_aspect_ratio'])
+	if aspect_ratios == DEFAULT_ASPECT_RATIOS:
+		return set(ORIENTATIONS) | {ORIENTATION_OTHER}
+	for orientation, orientation_aspect_ratios in ORIENTATIONS.items():
+		if aspect_ratios == orientation_aspect_ratios:
+			return {orientation}
+	return None
+
+
+# Set bit offsets of every byte value, for unpacking bitmaps
+BYTE_BITS = [[bit for bit in range(8) if byte >> bit & 1] for byte in range(256)]
+
+def build_bitmaps(values):
+	# Bit n of each value's bitmap is set when values[n] is that value
+	buffers = {}
+	for pos, value in enumerate(values):
+		if value not in buffers:
+			buffers[value] = bytearray()
+		buffer = buffers[value]
+		byte = pos >> 3
+		if len(buffer) <= byte:
+			buffer.extend(bytes(byte - len(buffer) + 1))
+		buffer[byte] |= 1 << (pos & 7)
+	return { value: int.from_bytes(buffer, 'little') for value, buffer in buffers.items() }
+
+def insert_bit(bitmap, pos):
+	# Open a clear bit at pos, moving the higher bits up one
+	low = (1 << pos) - 1
+	return bitmap & low | (bitmap & ~low) << 1
+
+def remove_bit(bitmap, pos):
+	# Close the bit at pos, moving the higher bits down one
+	return bitmap & (1 << pos) - 1 | bitmap >> pos + 1 << pos
+
+def positions_to_bitmap(positions, size):
+	buffer = bytearray((size + 7) // 8)
+	for pos in positions:
+		buffer[pos >> 3] |= 1 << (pos & 7)
+	return int.from_bytes(buffer, 'little')
+
+def get_nth_bit(bitmap, n):
+	# Position of the nth set bit, counting from zero
+	data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+	for start in range(0, len(data), 64):
+		chunk = data[start:start + 64]
+		count = int.from_bytes(chunk, 'little').bit_count()
+		if n >= count:
+			n -= count
+			continue
+		for byte, value in enumerate(chunk):
+			bits = BYTE_BITS[value]
+			if n < len(bits):
+				return ((start + byte) << 3) + bits[n]
+			n -= len(bits)
+	return None
+
+def iter_bits(bitmap, start=None, reverse=False):
+	# Set bit positions from start onwards, or from start down when reversed
+	if start is not None:
+		if reverse:
+			bitmap &= (1 << max(start + 1, 0)) - 1
+		elif start > 0:
+			bitmap = bitmap >> start << start
+	data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+	chunks = range(0, len(data), 64)
+	if reverse:
+		chunks = reversed(chunks)
+	for byte in chunks:
+		chunk = int.from_bytes(data[byte:byte + 64], 'little')
+		offset = byte << 3
+		while chunk:
+			if reverse:
+				bit = chunk.bit_length() - 1
+			else:
+				bit = (chunk & -chunk).bit_length() - 1
+			chunk ^= 1 << bit
+			yield offset + bit
+
+def bitmap_to_positions(bitmap, size):
+	positions = array.array('q')
+	for byte, value in enumerate(bitmap.to_bytes((size + 7) // 8, 'little')):
+		if value:
+			offset = byte << 3
+			positions.extend([offset + bit for bit in BYTE_BITS[value]])
+	return positions
+
+
+def shift_positions(positions, start, change):
+	# Renumber the positions at or after start in a sorted position array
+	for i in range(bisect.bisect_left(positions, start), len(positions)):
+		positions[i] += change
+
+
+def get_tokens(text):
+	return re.findall(r'\w+', text.lower())
+
+
+def get_filter_key(filters):
+	return tuple(sorted(filters.items()))
+
+def get_filter_hash(filters):
+	return hashlib.sha1(repr(get_filter_key(filters)).encode('utf-8')).hexdigest()[:8]
+
+def permute(index, size, seed):
+	# Four round Feistel network over the smallest even bit width covering size, cycling until the result fits
+	half = max(1, ((size - 1).bit_length() + 1) // 2)
+	mask = (1 << half) - 1
+	keys = [mix(seed * 4 + round + 1) for round in range(4)]
+	value = index
+	while True:
+		left = value >> half
+		right = value & mask
+		for key in keys:
+			left, right = right, left ^ (mix(right + key) >> 32 & mask)
+		value = left << half | right
+		if value < size:
+			return value
+
+def mix(value):
+	value = value * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF
+	value ^= value >> 31
+	value = value * 0xBF58476D1CE4E5B9 & 0xFFFFFFFFFFFFFFFF
+	return value ^ value >> 29
+
+
+# Bounded by entry count and optionally by bytes, when callers pass each value's size
+class LRUCache:
+	def __init__(self, max_size=64, max_bytes=None):
+		self.max_size = max_size
+		self.max_bytes = max_bytes
+		self.entries = collections.OrderedDict()
+		self.sizes = {}
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def __contains__(self, key):
+		return key in self.entries
+	
+	def get(self, key):
+		if key not in self.entries:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.entries.move_to_end(key)
+		return self.entries[key]
+	
+	def set(self, key, value, size=0):
+		self.discard(key)
+		self.entries[key] = value
+		self.sizes[key] = size
+		self.bytes += size
+		while len(self.entries) > self.max_size or (self.max_bytes and self.bytes > self.max_bytes and len(self.entries) > 1):
+			old_key, old_value = self.entries.popitem(last=False)
+			self.bytes -= self.sizes.pop(old_key)
+			self.evictions += 1
+	
+	def discard(self, key):
+		if key in self.entries:
+			del self.entries[key]
+			self.bytes -= self.sizes.pop(key)
+	
+	def clear(self):
+		self.entries.clear()
+		self.sizes.clear()
+		self.bytes = 0
+	
+	def get_stats(self):
+		lookups = self.hits + self.misses
+		stats = {
+			"size": len(self.entries),
+			"max_size": self.max_size,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"hit_rate": round(self.hits / lookups, 4) if lookups else 0
+		}
+		if self.max_bytes:
+			stats['bytes'] = self.bytes
+			stats['max_bytes'] = self.max_bytes
+		return stats
+
+
+# Prompt fields repeat heavily, so each distinct value is stored once and images hold 4-byte codes
+class StringColumn:
+	def __init__(self, values=None, codes=None):
+		self.values = values or ['']
+		self.value_codes = { value: code for code, value in enumerate(self.values) }
+		self.codes = codes if codes is not None else array.array('i')
+	
+	def __len__(self):
+		return len(self.codes)
+	
+	def __getitem__(self, pos):
+		return self.values[self.codes[pos]]
+	
+	def insert(self, pos, value):
+		code = self.value_codes.get(value)
+		if code is None:
+			code = len(self.values)
+			self.value_codes[value] = code
+			self.values.append(value)
+		self.codes.insert(pos, code)
+	
+	def __delitem__(self, pos):
+		del self.codes[pos]
+	
+	def find(self, function):
+		# Calls function once per distinct value
+		codes = { code for code, value in enumerate(self.values) if function(value) }
+		return [pos for pos, code in enumerate(self.codes) if code in codes]
+
+
+# Columnar index of the images table, one position per image in create_time order
+class ImageIndex:
+	def __init__(self, records=None, cache_size=64, log_level=5):
+		self.log_level = log_level
+		self.cache = LRUCache(cache_size)
+		self.watermark = ''
+		self.clear()
+		if records:
+			self.load(records)
+	
+	def clear(self):
+		self.filename = []
+		self.create_time = []
+		self.id = array.array('q')
+		self.aspect_ratio = array.array('d')
+		self.score = array.array('b')
+		self.nsfw = array.array('b')
+		self.version = array.array('b')
+		self.artist = array.array('q')
+		self.artist_name = StringColumn()
+		self.subject = StringColumn()
+		self.style = StringColumn()
+		self.artist_text = StringColumn()
+		self.tokens = {}
+		self.filename_positions = {}
+		
+		self.artist_ids = []
+		self.artist_codes = {}
+		self.artist_positions = {}
+		self.counts = {
+			"images": 0,
+			"fails": 0
+		}
+		# Image counts keyed by (artist, score, nsfw, version, orientation)
+		self.facets = collections.Counter()
+		self.bitmaps = None
+		self.aspect_ratios = []
+		self.cache.clear()
+	
+	def __len__(self):
+		return len(self.id)
+	
+	def load(self, records):
+		records = sorted(records, key=get_sort_key)
+		if records and len(self) and get_sort_key(records[0]) < (self.create_time[-1], self.filename[-1]):
+			# Older records are slotted in place, shifting the newer positions up,
+			# unless that would shift more than a rebuild in order costs
+			shifted = sum(len(self) - self.seek(record['create_time'], record['filename']) for record in records)
+			if shifted > len(self):
+				records = sorted([self.get_record(pos) for pos in range(len(self))] + records, key=get_sort_key)
+				self.clear()
+		for record in records:
+			self._insert(record)
+		self.cache.clear()
+	
+	def merge(self, records):
+		# Score, nsfw and aspect ratio change in place, anything else removes and reinserts the image
+		new_records = []
+		updated = 0
+		for record in records:
+			pos = self.find_filename(record['filename'])
+			if pos is None:
+				new_records.append(record)
+				continue
+			current = self.get_record(pos)
+			if record['create_time'] != current['create_time'] or any(record.get(field, '') != current.get(field, '') for field in TEXT_FIELDS):
+				self._remove(pos)
+				new_records.append(record)
+				continue
+			self._set_watermark(record)
+			score = self._score_code(record)
+			nsfw = 1 if record.get('nsfw') else 0
+			aspect_ratio = float(record.get('aspect_ratio', 1.0))
+			if (score, nsfw, aspect_ratio) == (self.score[pos], self.nsfw[pos], self.aspect_ratio[pos]):
+				continue
+			self._count(pos, -1)
+			self._move_bit('score', pos, self.score[pos], score)
+			self._move_bit('nsfw', pos, self.nsfw[pos], nsfw)
+			self._move_bit('orientation', pos, get_orientation(self.aspect_ratio[pos]), get_orientation(aspect_ratio))
+			self._move_bit('aspect_ratio', pos, self.aspect_ratio[pos], aspect_ratio)
+			self.score[pos] = score
+			self.nsfw[pos] = nsfw
+			self.aspect_ratio[pos] = aspect_ratio
+			self._count(pos, 1)
+			updated += 1
+		
+		updated += len(new_records)
+		if updated:
+			self.load(new_records)
+		return updated
+	
+	def remove(self, filenames):
+		removed = 0
+		for filename in filenames:
+			pos = self.find_filename(filename)
+			if pos is not None:
+				self._remove(pos)
+				removed += 1
+		if removed:
+			self.cache.clear()
+		return removed
+	
+	def _set_watermark(self, record):
+		watermark = max(record['create_time'], record.get('update_time') or '')
+		if watermark > self.watermark:
+			self.watermark = watermark
+	
+	def _insert(self, record):
+		# Newer than the newest indexed image in the usual case, so appended
+		pos = len(self)
+		if pos and get_sort_key(record) < (self.create_time[-1], self.filename[-1]):
+			pos = self.seek(record['create_time'], record['filename'])
+			self._shift(pos, 1)
+		
+		image_id = common.get_epoch(record['create_time'] + '+00:00')
+		artist_id = record.get('query-artist_id')
+		if not artist_id and record.get('query-artist_name'):
+			artist_id = common.convert_to_snakecase(common.normalize(record['query-artist_name'], strip_single_chars=False))
+		
+		self.filename.insert(pos, record['filename'])
+		self.create_time.insert(pos, record['create_time'])
+		self.id.insert(pos, image_id)
+		self.aspect_ratio.insert(pos, float(record.get('aspect_ratio', 1.0)))
+		self.score.insert(pos, self._score_code(record))
+		self.nsfw.insert(pos, 1 if record.get('nsfw') else 0)
+		self.version.insert(pos, get_version(image_id))
+		self.artist.insert(pos, self.get_artist_code(artist_id, create=True))
+		self.artist_name.insert(pos, record.get('query-artist_name', ''))
+		self.subject.insert(pos, record.get('query-subject', ''))
+		self.style.insert(pos, record.get('query-style', ''))
+		
+		# Normalize once at load; searches run against these instead of the raw fields
+		artist_text = common.normalize(record.get('query-artist_name', ''))
+		self.artist_text.insert(pos, artist_text)
+		
+		self.filename_positions[record['filename']] = pos
+		self._add_bits(pos)
+		self._add_artist_position(pos)
+		self._set_watermark(record)
+		self._count(pos, 1)
+		
+		search_text = ' '.join([artist_text, common.normalize(record.get('query-subject', '')), common.normalize(record.get('query-style', ''))])
+		for token in set(get_tokens(search_text)):
+			if token not in self.tokens:
+				self.tokens[token] = array.array('q')
+			bisect.insort(self.tokens[token], pos)
+		return pos
+	
+	def _remove(self, pos):
+		self._count(pos, -1)
+		if self.bitmaps is not None:
+			for bitmaps in self.bitmaps.values():
+				if isinstance(bitmaps, dict):
+					for value, bitmap in bitmaps.items():
+						bitmaps[value] = remove_bit(bitmap, pos)
+			self.bitmaps['all'] >>= 1
+		for positions in itertools.chain(self.tokens.values(), self.artist_positions.values()):
+			i = bisect.bisect_left(positions, pos)
+			if i < len(positions) and positions[i] == pos:
+				del positions[i]
+		
+		del self.filename_positions[self.filename[pos]]
+		for name in ['filename', 'create_time', 'id', 'aspect_ratio', 'score', 'nsfw', 'version', 'artist', 'artist_name', 'subject', 'style', 'artist_text']:
+			del getattr(self, name)[pos]
+		self._shift(pos, -1)
+	
+	def _shift(self, start, change):
+		# Renumber every position at or after start in the lookups and posting lists
+		for filename in self.filename[start:]:
+			self.filename_positions[filename] += change
+		for positions in itertools.chain(self.tokens.values(), self.artist_positions.values()):
+			if positions and positions[-1] >= start:
+				shift_positions(positions, start, change)
+	
+	def get_artist_code(self, artist_id, create=False):
+		if not artist_id:
+			return ARTIST_NONE
+		if artist_id in self.artist_codes:
+			return self.artist_codes[artist_id]
+		if not create:
+			return None
+		self.artist_codes[artist_id] = len(self.artist_ids)
+		self.artist_ids.append(artist_id)
+		return self.artist_codes[artist_id]
+	
+	def get_artist_positions(self, artist_id):
+		artist_code = self.get_artist_code(artist_id)
+		if artist_code is None or artist_code == ARTIST_NONE:
+			return array.array('q')
+		return self.artist_positions.get(artist_code, array.array('q'))
+	
+	def _add_artist_position(self, pos):
+		artist_code = self.artist[pos]
+		if artist_code == ARTIST_NONE:
+			return
+		if artist_code not in self.artist_positions:
+			self.artist_positions[artist_code] = array.array('q')
+		bisect.insort(self.artist_positions[artist_code], pos)
+	
+	def find_filename(self, filename):
+		return self.filename_positions.get(filename)
+	
+	def find_id(self, image_id):
+		# Ids are create_time epochs, so the id column is already sorted
+		pos = bisect.bisect_right(self.id, image_id) - 1
+		if pos < 0 or self.id[pos] != image_id:
+			return None
+		return pos
+	
+	def seek(self, create_time, filename):
+		# Position of the image, or where it would be inserted
+		low = bisect.bisect_left(self.create_time, create_time)
+		high = bisect.bisect_right(self.create_time, create_time, low)
+		return bisect.bisect_left(self.filename, filename, low, high)
+	
+	def search(self, query):
+		# Positions whose artist, subject or style contain every word in query
+		postings = []
+		for token in set(get_tokens(query)):
+			if token not in self.tokens:
+				return []
+			postings.append(self.tokens[token])
+		if not postings:
+			return []
+		postings.sort(key=len)
+		
+		# Walk the shortest posting list and binary search the rest
+		matches = []
+		for pos in postings[0]:
+			for posting in postings[1:]:
+				i = bisect.bisect_left(posting, pos)
+				if i == len(posting) or posting[i] != pos:
+					break
+			else:
+				matches.append(pos)
+		return matches
+	
+	def set_score(self, pos, score=None, nsfw=None):
+		# Cached results are only dropped if something changed
+		if score is None:
+			score = self.score[pos]
+		if nsfw is None:
+			nsfw = self.nsfw[pos]
+		changed = self._set_score(pos, score, 1 if nsfw else 0)
+		if changed:
+			self.cache.clear()
+		return changed
+	
+	def _set_score(self, pos, score, nsfw):
+		if self.score[pos] == score and self.nsfw[pos] == nsfw:
+			return False
+		self._count(pos, -1)
+		self._move_bit('score', pos, self.score[pos], score)
+		self._move_bit('nsfw', pos, self.nsfw[pos], nsfw)
+		self.score[pos] = score
+		self.nsfw[pos] = nsfw
+		self._count(pos, 1)
+		return True
+	
+	def _count(self, pos, change):
+		cell = (self.artist[pos], self.score[pos], self.nsfw[pos], self.version[pos], get_orientation(self.aspect_ratio[pos]))
+		self.facets[cell] += change
+		if not self.facets[cell]:
+			del self.facets[cell]
+		
+		if self.nsfw[pos]:
+			return
+		score = self.score[pos]
+		if score == 1:
+			self.counts['fails'] += change
+		elif score == SCORE_NONE or score >= 3:
+			self.counts['images'] += change
+	
+	def write_snapshot(self, path):
+		# Magic number, JSON header locating each block, then the raw column bytes and posting lists
+		header = {
+			"format": SNAPSHOT_FORMAT,
+			"watermark": self.watermark,
+			"blocks": {}
+		}
+		blocks = []
+		offset = 0
+		
+		tokens = list(self.tokens)
+		token_offsets = array.array('q', [0])
+		token_postings = array.array('q')
+		for token in tokens:
+			token_postings.extend(self.tokens[token])
+			token_offsets.append(len(token_postings))
+		
+		columns = [(name, getattr(self, name)) for name in SNAPSHOT_ARRAYS + SNAPSHOT_STRINGS]
+		for name in SNAPSHOT_STRING_COLUMNS:
+			column = getattr(self, name)
+			columns += [(name + '_values', column.values), (name + '_codes', column.codes)]
+		columns += [('tokens', tokens), ('token_offsets', token_offsets), ('token_postings', token_postings)]
+		for name, column in columns:
+			if isinstance(column, array.array):
+				typecode = column.typecode
+				data = column.tobytes()
+			else:
+				typecode = None
+				data = '\0'.join(column).encode('utf-8')
+			header['blocks'][name] = [typecode, offset, len(data), len(column)]
+			blocks.append(data)
+			offset += len(data)
+		
+		header_data = json.dumps(header).encode('utf-8')
+		tmp_path = path + '.tmp'
+		with open(tmp_path, 'wb') as file:
+			file.write(SNAPSHOT_MAGIC)
+			file.write(struct.pack('<I', len(header_data)))
+			file.write(header_data)
+			for data in blocks:
+				file.write(data)
+		os.replace(tmp_path, path)
+		return True
+	
+	@classmethod
+	def read_snapshot(cls, path, **kwargs):
+		# None if the file is missing or unreadable
+		try:
+			with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+				if data[:4] != SNAPSHOT_MAGIC:
+					return None
+				header_length = struct.unpack('<I', data[4:8])[0]
+				header = json.loads(data[8:8 + header_length])
+				if header['format'] != SNAPSHOT_FORMAT:
+					return None
+				start = 8 + header_length
+				
+				columns = {}
+				for name, (typecode, offset, length, count) in header['blocks'].items():
+					block = data[start + offset:start + offset + length]
+					if len(block) != length:
+						return None
+					if typecode:
+						column = array.array(typecode)
+						if column.itemsize * count != length:
+							return None
+						column.frombytes(block)
+					elif count:
+						column = block.decode('utf-8').split('\0')
+						if len(column) != count:
+							return None
+					else:
+						column = []
+					columns[name] = column
+			
+			index = cls(**kwargs)
+			for name in SNAPSHOT_ARRAYS + SNAPSHOT_STRINGS:
+				setattr(index, name, columns[name])
+			for name in SNAPSHOT_STRING_COLUMNS:
+				setattr(index, name, StringColumn(columns[name + '_values'], columns[name + '_codes']))
+			if any(len(getattr(index, name)) != len(index.id) for name in ['filename', 'create_time', 'aspect_ratio', 'score', 'nsfw', 'artist'] + SNAPSHOT_STRING_COLUMNS):
+				return None
+			index._set_versions()
+			token_offsets = columns['token_offsets']
+			token_postings = columns['token_postings']
+			for i, token in enumerate(columns['tokens']):
+				index.tokens[token] = token_postings[token_offsets[i]:token_offsets[i + 1]]
+			index.artist_codes = { artist_id: code for code, artist_id in enumerate(index.artist_ids) }
+			index.filename_positions = dict(zip(index.filename, range(len(index.filename))))
+			index.watermark = header['watermark']
+			for pos in range(len(index.id)):
+				index._add_artist_position(pos)
+				index._count(pos, 1)
+		except (OSError, ValueError, KeyError, IndexError, struct.error):
+			return None
+		return index
+	
+	def count(self, filters):
+		# Facet counts, or a popcount of the filter bitmap for text searches and custom aspect ratios
+		cells = self._get_facet_cells(filters)
+		if cells is not None:
+			return sum(count for cell, count in cells)
+		return self.get_bitmap(filters).bit_count()
+	
+	def get_facets(self, filters):
+		facets = {
+			"score": collections.Counter(),
+			"version": collections.Counter(),
+			"nsfw": collections.Counter(),
+			"orientation": collections.Counter(),
+			"artist_id": collections.Counter()
+		}
+		cells = self._get_facet_cells(filters)
+		if cells is None:
+			cells = []
+			for pos in self.select(filters):
+				cells.append(((self.artist[pos], self.score[pos], self.nsfw[pos], self.version[pos], get_orientation(self.aspect_ratio[pos])), 1))
+		
+		total = 0
+		for (artist, score, nsfw, version, orientation), count in cells:
+			total += count
+			facets['score'][score if score != SCORE_NONE else 'none'] += count
+			facets['version'][version] += count
+			facets['nsfw'][bool(nsfw)] += count
+			facets['orientation'][orientation or 'none'] += count
+			if artist != ARTIST_NONE:
+				facets['artist_id'][self.artist_ids[artist]] += count
+		
+		facets = { name: dict(counter) for name, counter in facets.items() }
+		facets['total'] = total
+		return facets
+	
+	def _get_facet_cells(self, filters):
+		if filters['search'] or filters['artist']:
+			return None
+		orientations = get_orientations(filters)
+		if orientations is None:
+			return None
+		artist_code = None
+		if filters['artist_id']:
+			artist_code = self.get_artist_code(filters['artist_id'])
+			if artist_code is None:
+				return []
+		
+		cells = []
+		for cell, count in self.facets.items():
+			artist, score, nsfw, version, orientation = cell
+			if artist_code is not None and artist != artist_code:
+				continue
+			if orientation not in orientations:
+				continue
+			if filters['nsfw'] is not None and nsfw != (1 if filters['nsfw'] else 0):
+				continue
+			if filters['exact_score'] == 'no_score':
+				if score != SCORE_NONE:
+					continue
+			elif filters['exact_score']:
+				if score != filters['exact_score']:
+					continue
+			elif filters['score'] and (score == SCORE_NONE or not score or score < filters['score']):
+				continue
+			if filters['exact_version']:
+				if version != filters['exact_version']:
+					continue
+			elif filters['version'] and version < filters['version']:
+				continue
+			cells.append((cell, count))
+		return cells
+	
+	def get_counts(self):
+		return self.counts.copy()
+	
+	def get_stats(self):
+		return {
+			"images": len(self),
+			"artists": len(self.artist_ids),
+			"tokens": len(self.tokens),
+			"cache": self.cache.get_stats()
+		}
+	
+	def get_record(self, pos):
+		# The key record in the shape read from DynamoDB
+		record = {
+			"filename": self.filename[pos],
+			"create_time": self.create_time[pos],
+			"id": self.id[pos],
+			"aspect_ratio": self.aspect_ratio[pos],
+			"nsfw": bool(self.nsfw[pos]),
+			"version": self.version[pos]
+		}
+		if self.score[pos] != SCORE_NONE:
+			record['score'] = self.score[pos]
+		if self.artist[pos] != ARTIST_NONE:
+			record['query-artist_id'] = self.artist_ids[self.artist[pos]]
+		for field, column in zip(TEXT_FIELDS, [self.artist_name, self.subject, self.style]):
+			if column[pos]:
+				record[field] = column[pos]
+		return record
+	
+	def select(self, filters):
+		# Cached, so callers must not modify the returned array
+		positions = self.cache.get(get_filter_key(filters))
+		if positions is not None:
+			return positions
+		
+		positions = bitmap_to_positions(self.get_bitmap(filters), len(self))
+		self.cache.set(get_filter_key(filters), positions)
+		return positions
+	
+	def iter_matches(self, filters, start=None, reverse=False):
+		# Read off the filter bitmap as consumed, so stopping early is cheap
+		positions = self.cache.get(get_filter_key(filters))
+		if positions is not None:
+			if reverse:
+				end = len(positions) if start is None else bisect.bisect_right(positions, start)
+				for i in range(end - 1, -1, -1):
+					yield positions[i]
+			else:
+				begin = 0 if start is None else bisect.bisect_left(positions, start)
+				for i in range(begin, len(positions)):
+					yield positions[i]
+			return
+		
+		yield from iter_bits(self.get_bitmap(filters), start, reverse)
+	
+	def matches(self, pos, filters):
+		return bool(self.get_bitmap(filters) >> pos & 1)
+	
+	def sample(self, filters, count=1, unique=False, rng=random):
+		# Random matches and their total, drawn without replacement when unique is set
+		positions = None
+		if get_filter_key(filters) in self.cache:
+			positions = self.select(filters)
+		if positions is not None:
+			total = len(positions)
+			if not total:
+				return [], 0
+			if unique:
+				return rng.sample(positions, min(count, total)), total
+			return [positions[rng.randrange(total)] for i in range(count)], total
+		
+		bitmap = self.get_bitmap(filters)
+		total = bitmap.bit_count()
+		if not total:
+			return [], 0
+		size = len(self)
+		if unique and count * 2 > total:
+			return rng.sample(bitmap_to_positions(bitmap, size), min(count, total)), total
+		
+		# Test random positions against the bitmap while it is dense enough,
+		# otherwise count through it to a random match
+		dense = total * SAMPLE_DENSITY >= size
+		picks = []
+		while len(picks) < count:
+			if dense:
+				pos = rng.randrange(size)
+				if not bitmap >> pos & 1:
+					continue
+			else:
+				pos = get_nth_bit(bitmap, rng.randrange(total))
+			if unique and pos in picks:
+				continue
+			picks.append(pos)
+		return picks, total
+	
+	def count_newer(self, filters, pos):
+		positions = self.cache.get(get_filter_key(filters))
+		if positions is not None:
+			return len(positions) - bisect.bisect_right(positions, pos)
+		return (self.get_bitmap(filters) >> pos + 1).bit_count()
+	
+	def get_shuffled(self, filters, seed, size, start, count):
+		# A seeded permutation of the first size matches, so a session keeps its order as images are added
+		if not size:
+			return []
+		total = self.count(filters)
+		if not total:
+			return []
+		
+		positions = None
+		if get_filter_key(filters) in self.cache:
+			positions = self.select(filters)
+		else:
+			bitmap = self.get_bitmap(filters)
+		
+		picks = []
+		for i in range(start, start + count):
+			rank = permute(i % size, size, seed) % total
+			if positions is not None:
+				picks.append(positions[rank])
+			else:
+				picks.append(get_nth_bit(bitmap, rank))
+		return picks
+	
+	def get_bitmap(self, filters):
+		# Cached next to select()'s, since a request resolves the same filters several times
+		key = ('bitmap',) + get_filter_key(filters)
+		bitmap = self.cache.get(key)
+		if bitmap is not None:
+			return bitmap
+		
+		bitmaps = self._get_bitmaps()
+		bitmap = bitmaps['all']
+		
+		if filters['search'] or filters['artist'] or filters['artist_id']:
+			bitmap &= self._match_text(filters)
+		
+		orientations = get_orientations(filters)
+		if orientations is not None:
+			bitmap &= self._any_bitmap('orientation', orientations)
+		else:
+			bitmap &= self._get_aspect_ratio_bitmap(filters['min_aspect_ratio'], filters['max_aspect_ratio'])
+		
+		if filters['nsfw'] is not None:
+			bitmap &= bitmaps['nsfw'].get(1 if filters['nsfw'] else 0, 0)
+		
+		if filters['exact_score'] == 'no_score':
+			bitmap &= bitmaps['score'].get(SCORE_NONE, 0)
+		elif filters['exact_score']:
+			bitmap &= bitmaps['score'].get(filters['exact_score'], 0)
+		elif filters['score']:
+			bitmap &= self._any_bitmap('score', [score for score in bitmaps['score'] if score != SCORE_NONE and score and score >= filters['score']])
+		
+		if filters['exact_version'] or filters['version']:
+			if filters['exact_version']:
+				start, end = self.get_version_positions(filters['exact_version'])
+			else:
+				start, end = self.get_version_positions(filters['version'], exact=False)
+			bitmap &= (1 << end) - (1 << start)
+		
+		self.cache.set(key, bitmap)
+		return bitmap
+	
+	def _get_bitmaps(self):
+		# Per-value bitmaps of the categorical columns, built on first use
+		if self.bitmaps is None:
+			self.bitmaps = {
+				"all": (1 << len(self)) - 1,
+				"nsfw": build_bitmaps(self.nsfw),
+				"score": build_bitmaps(self.score),
+				"orientation": build_bitmaps(map(get_orientation, self.aspect_ratio)),
+				"aspect_ratio": build_bitmaps(self.aspect_ratio)
+			}
+			self.aspect_ratios = sorted(self.bitmaps['aspect_ratio'])
+		return self.bitmaps
+	
+	def get_version_positions(self, version, exact=True):
+		# Versions are eras of image ids, so each is a contiguous slice
+		i = bisect.bisect_left(VERSION_NUMBERS, version)
+		if i == len(VERSIONS):
+			return len(self), len(self)
+		start = 0 if i == 0 else bisect.bisect_right(self.id, VERSIONS[i - 1][1])
+		if exact and VERSIONS[i][0] != version:
+			return start, start
+		last_id = VERSIONS[i][1]
+		if not exact or last_id is None:
+			return start, len(self)
+		return start, bisect.bisect_right(self.id, last_id)
+	
+	def _set_versions(self):
+		self.version = array.array('b')
+		for version, last_id in VERSIONS:
+			end = len(self.id) if last_id is None else bisect.bisect_right(self.id, last_id)
+			self.version.extend(array.array('b', [version]) * (end - len(self.version)))
+	
+	def _get_aspect_ratio_bitmap(self, min_aspect_ratio, max_aspect_ratio):
+		# The distinct aspect ratios are sorted, so a range is two binary searches
+		key = ('aspect_ratio', min_aspect_ratio, max_aspect_ratio)
+		bitmap = self.cache.get(key)
+		if bitmap is None:
+			start = bisect.bisect_left(self.aspect_ratios, min_aspect_ratio)
+			end = bisect.bisect_right(self.aspect_ratios, max_aspect_ratio)
+			bitmap = self._any_bitmap('aspect_ratio', self.aspect_ratios[start:end])
+			self.cache.set(key, bitmap)
+		return bitmap
+	
+	def _any_bitmap(self, name, values):
+		bitmap = 0
+		for value in values:
+			bitmap |= self.bitmaps[name].get(value, 0)
+		return bitmap
+	
+	def _move_bit(self, name, pos, old_value, new_value):
+		if self.bitmaps is None or old_value == new_value:
+			return
+		self.bitmaps[name][old_value] &= ~(1 << pos)
+		self._set_bit(name, pos, new_value)
+	
+	def _set_bit(self, name, pos, value):
+		bitmaps = self.bitmaps[name]
+		if value not in bitmaps:
+			bitmaps[value] = 0
+			if name == 'aspect_ratio':
+				bisect.insort(self.aspect_ratios, value)
+		bitmaps[value] |= 1 << pos
+	
+	def _add_bits(self, pos):
+		# Keep built bitmaps current as images are added, rather than rebuilding them
+		if self.bitmaps is None:
+			return
+		if pos < len(self) - 1:
+			for bitmaps in self.bitmaps.values():
+				if isinstance(bitmaps, dict):
+					for value, bitmap in bitmaps.items():
+						bitmaps[value] = insert_bit(bitmap, pos)
+		self.bitmaps['all'] = (1 << len(self)) - 1
+		self._set_bit('nsfw', pos, self.nsfw[pos])
+		self._set_bit('score', pos, self.score[pos])
+		self._set_bit('orientation', pos, get_orientation(self.aspect_ratio[pos]))
+		self._set_bit('aspect_ratio', pos, self.aspect_ratio[pos])
+	
+	def _match_text(self, filters):
+		# Text matches don't depend on the other filters, so they are cached on their own
+		key = ('text', filters['search'], filters['artist'], filters['artist_id'])
+		bitmap = self.cache.get(key)
+		if bitmap is not None:
+			return bitmap
+		
+		matches = set()
+		if filters['search']:
+			matches.update(self.search(filters['search']))
+		
+		if filters['artist_id']:
+			matches.update(self.get_artist_positions(filters['artist_id']))
+		
+		if filters['artist']:
+			artist_re = re.compile(r'\b{}\b'.format(filters['artist']), re.IGNORECASE)
+			matches.update(self.artist_text.find(artist_re.search))
+		bitmap = positions_to_bitmap(matches, len(self))
+		self.cache.set(key, bitmap)
+		return bitmap
+	
+	def _score_code(self, record):
+		if 'score' not in record or record['score'] is None:
+			return SCORE_NONE
+		return common.convert_to_int(record['score'])
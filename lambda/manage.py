@@ -5,6 +5,7 @@ import os
 import re
 import subprocess
 import sys
+import tempfile
 import time
 import wikipedia
 
@@ -20,6 +21,8 @@ import moses_common.stabilityai
 import moses_common.ui
 import moses_common.visual_artists as visual_artists
 
+import image_index
+
 
 ui = moses_common.ui.Interface(use_slack_format=True, usage_message="""
 Manage images and data for Art Intelligence.
@@ -29,6 +32,7 @@ Manage images and data for Art Intelligence.
   manage.py google                   # Search Brave for image results
   manage.py import <filename>        # Import images from image_generator.py
   manage.py new_artist <artist name> # Add new artist and default work record
+  manage.py publish_index            # Build the image index and publish it to S3
   manage.py refresh                  # Grab new artist file and sync to db
   manage.py send                     # Send local dev website to S3
   manage.py stats                    # Display category stats on image db
@@ -65,6 +69,8 @@ def handler(args, opts):
 		success, response = search_google(args['target'])
 # 	elif action == 'import':
 # 		success, response = import_image(args['file'], opts)
+	elif action == 'publish_index':
+		success, response = publish_index(opts)
 	elif action == 'refresh':
 		success, response = refresh_artists(opts)
 	elif action == 'reload':
@@ -382,6 +388,40 @@ def reload_db(target):
 		return True, f"Set {target} to reload"
 	return False, "Unknown target db"
 
+def publish_index(opts):
+	table = moses_common.dynamodb.Table('artintelligence.gallery-images', log_level=log_level, dry_run=dry_run)
+	records = table.get_keys(image_index.INDEX_FIELDS)
+	index = image_index.ImageIndex(records, log_level=log_level)
+	
+	dt = common.get_dt_now()
+	object_name = f"index/images-{dt.strftime('%Y%m%d%H%M%S')}.snapshot"
+	pointer = {
+		"key": object_name,
+		"watermark": index.watermark,
+		"images": len(index),
+		"create_time": common.convert_datetime_to_string(dt)
+	}
+	if dry_run:
+		ui.body(f"Would upload snapshot of {len(index)} images to {object_name}")
+		return True, pointer
+	
+	# Build the artifact in a temp dir, apart from the local API's own snapshot
+	with tempfile.TemporaryDirectory() as temp_dir:
+		file_path = os.path.join(temp_dir, 'image-index.snapshot')
+		index.write_snapshot(file_path)
+		
+		# Upload the versioned snapshot first so the pointer never names a missing object
+		bucket = moses_common.s3.Bucket(image_index.SNAPSHOT_BUCKET)
+		file = moses_common.s3.Object(bucket, object_name)
+		file.upload_file(file_path)
+		
+		pointer_path = file_path + '.json'
+		with open(pointer_path, 'w') as pointer_file:
+			pointer_file.write(common.make_json(pointer))
+		file = moses_common.s3.Object(bucket, image_index.SNAPSHOT_POINTER)
+		file.upload_file(pointer_path)
+	return True, pointer
+
 def get_genre_stats(opts):
 	genre_table = moses_common.dynamodb.Table('artintelligence.gallery-works', log_level=log_level, dry_run=dry_run)
 	genre_records = genre_table.get_keys()